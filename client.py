@@ -1,12 +1,12 @@
 import socket
 import struct
-import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from config import *
-from colorama import Fore, init, Back
+from mmsg import ReceiveBatch
+from log import get_logger, RESULT_COLOR
 
-# Initialize the library for colored output in the terminal
-init(autoreset=True)
+logger = get_logger('client')
 
 def values_from_user():
     """
@@ -26,7 +26,7 @@ def values_from_user():
         
         # If provided wrong values throw an error 
         except ValueError as e:
-            print(Fore.WHITE + Back.RED + "Invalid input. Please enter positive values")
+            logger.error("Invalid input. Please enter positive values")
 
 
 
@@ -49,20 +49,20 @@ def find_server_offer():
 
             # Unpack the received data to retrieve the offer details
             try:
-                magic_cookie, message_type, udp_port, tcp_port = struct.unpack('!IBHH', offer_data)
+                magic_cookie, message_type, udp_port, tcp_port = OFFER_STRUCT.unpack(offer_data)
             except struct.error:   # Recieved malformed offer packet so ignores it
-                print(Fore.WHITE + Back.RED + "Malformed offer packet received")
+                logger.debug("Malformed offer packet received")
                 continue
 
             # Validate the offer details
             if magic_cookie == MAGIC_COOKIE and message_type == MTYPE_OFFER:
-                print(Fore.CYAN + Back.MAGENTA + f"Received offer from {sender_address[0]}")
+                logger.info(f"Received offer from {sender_address[0]}")
                 return sender_address[0], udp_port, tcp_port
             else:
-                print(Fore.WHITE + Back.RED + "Received invalid offer")
+                logger.debug("Received invalid offer")
 
         except Exception as error:
-            print(Fore.WHITE + Back.RED + f"Error while waiting for offers: {str(error)}")
+            logger.error(f"Error while waiting for offers: {str(error)}")
 
 
 
@@ -81,6 +81,7 @@ def manage_tcp_connection(server_ip, tcp_port, file_size, connection_number):
         # Create a TCP socket and establish a connection with the server
         client_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client_tcp_socket.connect((server_ip, tcp_port))
+        client_tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # Send the small size request without waiting to coalesce
 
         # Send the requested file size to the server
         client_tcp_socket.sendall(f"{file_size}\n".encode())
@@ -91,25 +92,26 @@ def manage_tcp_connection(server_ip, tcp_port, file_size, connection_number):
         # Initialize variables for tracking received data
         bytes_received = 0
         chunk_size = CONST_SIZE * 8  # Maximum size of a single data chunk
+        receive_view = memoryview(bytearray(chunk_size))  # Buffer reused by every receive call
 
         # Continuously receive data until the requested file size is reached
         while bytes_received < file_size:
-            data_to_rcv = client_tcp_socket.recv(min(chunk_size, file_size - bytes_received))
-            if not data_to_rcv:
+            received_size = client_tcp_socket.recv_into(receive_view[:min(chunk_size, file_size - bytes_received)])
+            if not received_size:
                 break
-            bytes_received += len(data_to_rcv)
+            bytes_received += received_size
 
-        # Calculate and print transfer statistics
+        # Calculate and report transfer statistics
         total_time = time.time() - start_time
         transfer_speed_bps = (bytes_received / total_time) * 8  # Convert to bits per second
 
-        # Print the resault values as asked
-        print(Fore.WHITE + Back.GREEN + f"TCP transfer #{connection_number} completed:\n"
-                          f"  Total time: {total_time:.2f} seconds\n"
-                          f"  Average speed: {transfer_speed_bps:.1f} bits/second")
+        # Report the resault values as asked
+        logger.info(f"TCP transfer #{connection_number} completed:\n"
+                    f"  Total time: {total_time:.2f} seconds\n"
+                    f"  Average speed: {transfer_speed_bps:.1f} bits/second", extra={'color': RESULT_COLOR})
 
     except Exception as error:
-        print(Fore.WHITE + Back.RED + f"Error in TCP connection #{connection_number}: {str(error)}")
+        logger.error(f"Error in TCP connection #{connection_number}: {str(error)}")
     
     finally:
         # Ensure the socket is closed properly
@@ -132,65 +134,91 @@ def manage_udp_connection(server_ip, udp_port, file_size, connection_number):
     try:
         # Create a UDP socket with a timeout for receiving data
         client_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client_udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)   # Avoid drops while the loop catches up
         client_udp_socket.settimeout(0.3)   # Set timeout to avoid waiting indefinitely
 
         # Send the request to the server with the magic cookie, message type, and file size
-        request_data = struct.pack('!IBQ', MAGIC_COOKIE, MTYPE_REQUEST, file_size)
+        request_data = REQUEST_STRUCT.pack(MAGIC_COOKIE, MTYPE_REQUEST, file_size)
         client_udp_socket.sendto(request_data, (server_ip, udp_port))
 
         start_time = time.time()
         total_segments = (file_size + 1024 - 1) // 1024   # Calculate how many segments the file will be split into
-        segments_received = {}   # Dictionary to track which segments have been received
+        received_bitmap = None   # One bit per segment to track which segments have been received
+        bitmap_segments = 0   # Number of segments the bitmap was sized for
+        received_count = 0   # Number of distinct segments received so far
+        max_seen_segment = -1   # Highest segment index received so far, the last segment is sent last
+        invalid_count = 0   # Number of packets ignored because of a wrong size, magic cookie or message type
         bytes_received = 0   # Total number of bytes received so far
         last_received = time.time()   # Track the time of the last received segment
+        receive_batch = ReceiveBatch(CONST_SIZE * 4)  # Buffers reused by every receive call, maximum size of a segment (4KB)
 
         while True:
             try:
-                # Wait for data from the server
-                received_data, _ = client_udp_socket.recvfrom(CONST_SIZE * 4)  # Maximum size of a segment (4KB)
+                # Wait for data from the server, every datagram already queued is read in one batch
+                received_datagrams = receive_batch.receive(client_udp_socket)
 
                 # Update the last receive time
                 last_received = time.time()
 
-                # Extract the header from the received data
-                header_size = struct.calcsize('!IBQQ')  # Size of the header portion
-                magic_cookie, message_type, total_segments, curr_segment = struct.unpack('!IBQQ', received_data[:header_size])
-
-                # Validate the received data
-                if magic_cookie != MAGIC_COOKIE or message_type != MTYPE_PAYLOAD:
-                    print(Fore.WHITE + Back.RED + "Received data is invalid: Incorrect magic cookie or message type")
-                    continue
-
-                # Calculate the data size by subtracting the header size
-                data_size = len(received_data) - header_size
-
-                # Track the segment if it's the first time we've received it
-                if curr_segment not in segments_received:
-                    segments_received[curr_segment] = data_size   # Add segment to the dictionary so we can track it
-                    bytes_received += data_size
+                for received_data in received_datagrams:
+                    # Validate the received data with a single compare of the magic cookie and message type,
+                    # invalid packets are only counted to keep the loop fast
+                    if len(received_data) < PAYLOAD_HEADER_STRUCT.size or received_data[:PAYLOAD_PREFIX_SIZE] != PAYLOAD_PREFIX:
+                        invalid_count += 1
+                        continue
+
+                    # Extract the segment fields from the header of the received data
+                    _, _, total_segments, curr_segment = PAYLOAD_HEADER_STRUCT.unpack_from(received_data)
+
+                    # Calculate the data size by subtracting the header size
+                    data_size = len(received_data) - PAYLOAD_HEADER_STRUCT.size
+
+                    # Allocate the bitmap once the number of segments is known from the first valid packet
+                    if received_bitmap is None:
+                        bitmap_segments = total_segments
+                        received_bitmap = bytearray((bitmap_segments + 7) // 8)
+                    if curr_segment >= bitmap_segments:
+                        continue   # Segment index outside of the transfer
+
+                    # Track the segment if it's the first time we've received it
+                    byte_index, bit = curr_segment >> 3, 1 << (curr_segment & 7)
+                    if not received_bitmap[byte_index] & bit:
+                        received_bitmap[byte_index] |= bit   # Mark the segment in the bitmap so we can track it
+                        bytes_received += data_size
+                        received_count += 1
+                        max_seen_segment = max(max_seen_segment, curr_segment)
 
                 # Check if all segments are received or if enough time has passed to conclude the transfer
-                if len(segments_received) >= total_segments or time.time() - last_received >= 1.5:
+                if received_count >= total_segments or time.time() - last_received >= 1.5:
+                    break
+
+                # The last segment arrived and nearly everything else did, the missing segments were lost
+                # so don't wait for the timeout
+                if max_seen_segment == total_segments - 1 and received_count >= UDP_COMPLETION_RATIO * total_segments:
                     break
 
             except socket.timeout:
                 # If there is a timeout but some data has been received, exit the loop
-                if segments_received:
+                if received_count:
                     break
 
         # Calculate the transfer time and speed
         total_time = time.time() - start_time
-        success_precent = (len(segments_received) / total_segments) * 100  # Percentage of successfully received packets
+        success_precent = (received_count / total_segments) * 100  # Percentage of successfully received packets
         trans_speed = (bytes_received * 8) / total_time  # Convert to bits per second
 
-        # Print the results of the transfer as asked
-        print(Fore.WHITE + Back.GREEN + f"UDP transfer #{connection_number} completed. "
-                        f"Time taken: {total_time:.2f} seconds, "
-                        f"Speed: {trans_speed:.1f} bits/second, "
-                        f"Successful packets: {success_precent:.0f}%")
+        # Report the results of the transfer as asked
+        logger.info(f"UDP transfer #{connection_number} completed. "
+                    f"Time taken: {total_time:.2f} seconds, "
+                    f"Speed: {trans_speed:.1f} bits/second, "
+                    f"Successful packets: {success_precent:.0f}%", extra={'color': RESULT_COLOR})
+
+        # Report the ignored packets once, after the transfer
+        if invalid_count:
+            logger.warning(f"UDP transfer #{connection_number} ignored {invalid_count} invalid packets")
 
     except Exception as error:
-        print(Fore.WHITE + Back.RED + f"Error in UDP connection #{connection_number}: {str(error)}")
+        logger.error(f"Error in UDP connection #{connection_number}: {str(error)}")
 
     # Close the UDP socket when finished    
     finally:
@@ -201,39 +229,32 @@ def manage_udp_connection(server_ip, udp_port, file_size, connection_number):
 def run_client():
     """
     Initiates the client, listens for server offers, and begins data transfers when receiving a valid offer.
-    Each connection (TCP and UDP) is handled in a separate thread.
+    Each connection (TCP and UDP) is handled by a worker of a thread pool.
     """
     file_size, tcp_conn_num, udp_conn_num = values_from_user()  # Retrieve the requested values from the user
 
+    # One worker per connection, the pool is reused for every round of transfers
+    executor = ThreadPoolExecutor(max_workers=tcp_conn_num + udp_conn_num)
+
     while True:
-        print(Fore.CYAN + Back.MAGENTA + "Client started, listening for offer requests...")
+        logger.info("Client started, listening for offer requests...")
 
         # Wait for offer from a server and retrieve the necessary connection details
         server_ip, udp_port, tcp_port = find_server_offer()
 
-        # List to hold all threads for concurrent connections
-        connection_threads = []
-
-        # Create a separate thread for each TCP connection
-        for i in range(tcp_conn_num):
-            thread = threading.Thread(target=manage_tcp_connection, args=(server_ip, tcp_port, file_size, i + 1))
-            connection_threads.append(thread)
-        
-        # Create a separate thread for each UDP connection
-        for i in range(udp_conn_num):
-            thread = threading.Thread(target=manage_udp_connection, args=(server_ip, udp_port, file_size, i + 1))
-            connection_threads.append(thread)
+        # Submit a task for each TCP connection
+        transfers = [executor.submit(manage_tcp_connection, server_ip, tcp_port, file_size, i + 1)
+                     for i in range(tcp_conn_num)]
 
-        # Start all threads
-        for thread in connection_threads:
-            thread.start()
+        # Submit a task for each UDP connection
+        transfers += [executor.submit(manage_udp_connection, server_ip, udp_port, file_size, i + 1)
+                      for i in range(udp_conn_num)]
 
-        # Ensure that all threads complete before proceeding
-        for thread in connection_threads:
-            thread.join()
+        # Ensure that all transfers complete before proceeding
+        wait(transfers)
 
         # After completing all transfers, continue waiting for new offers
-        print(Fore.CYAN + Back.MAGENTA + "All transfers complete, listening to offer requests")
+        logger.info("All transfers complete, listening to offer requests")
 
 
 
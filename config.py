@@ -1,3 +1,5 @@
+import struct
+
 # Constants to avoid hard coding
 TEAM_NAME = "Keren"
 
@@ -8,6 +10,33 @@ MTYPE_OFFER = 0x2
 MTYPE_REQUEST = 0x3
 MTYPE_PAYLOAD = 0x4
 
+# Packet formats, compiled once
+OFFER_STRUCT = struct.Struct('!IBHH')   # Magic cookie, message type, UDP port, TCP port
+REQUEST_STRUCT = struct.Struct('!IBQ')   # Magic cookie, message type, file size
+PAYLOAD_HEADER_STRUCT = struct.Struct('!IBQQ')   # Magic cookie, message type, total segments, current segment
+
+# Expected start of every payload packet, compared as raw bytes to validate it
+PAYLOAD_PREFIX = struct.pack('!IB', MAGIC_COOKIE, MTYPE_PAYLOAD)
+PAYLOAD_PREFIX_SIZE = len(PAYLOAD_PREFIX)
+
 # Other constants 
 CONST_SIZE = 1024
 BROADCAST_PORT = 39457 # Port number for broadcasting
+BROADCAST_ADDRESS = '<broadcast>' # INADDR_BROADCAST (255.255.255.255), reaches the local network on any subnet
+# Send and receive buffer size for the UDP transfer sockets (8MB).
+# Linux caps it at net.core.wmem_max / net.core.rmem_max, raise them with sysctl
+# (e.g. sysctl -w net.core.rmem_max=8388608 net.core.wmem_max=8388608) to get the full size.
+# TCP sockets keep the kernel defaults, setting a size explicitly would turn off buffer autotuning
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024
+# Optional maximum UDP send rate in bytes per second, enforced by the kernel (Linux with the fq qdisc).
+# Reported UDP speeds can't exceed this cap, so it is off (None) by default; set it only to keep
+# bursts from overrunning slow receivers, e.g. 125_000_000 for 1 Gbit/s
+UDP_PACING_RATE = None
+UDP_COMPLETION_RATIO = 0.995 # Share of UDP segments after which the transfer ends once the last segment arrived
+MMSG_BATCH = 43 # Number of datagrams handed to the kernel in a single sendmmsg call
+PAYLOAD_FILE_SIZE = 1024 * 1024 # Size of the random data repeated by TCP transfers (1MB)
+MAX_TCP_WORKERS = 32 # Threads serving TCP transfers on the server
+MAX_UDP_WORKERS = 8 # Threads serving UDP transfers on the server
+
+# Payload headers of a whole sendmmsg batch, written with a single pack_into call
+BATCH_HEADER_STRUCT = struct.Struct('!' + 'IBQQ' * MMSG_BATCH)
@@ -0,0 +1,51 @@
+import logging
+import sys
+from colorama import init, Fore, Back, Style
+
+# Colors are only used when writing to a terminal, so redirected output stays plain
+USE_COLOR = sys.stdout.isatty()
+
+# Initialize the library for colored output in the terminal
+if USE_COLOR:
+    init()
+
+# Colors for each log level
+LEVEL_COLORS = {
+    logging.DEBUG: Fore.WHITE + Back.RED,
+    logging.INFO: Fore.CYAN + Back.MAGENTA,
+    logging.WARNING: Fore.WHITE + Back.RED,
+    logging.ERROR: Fore.WHITE + Back.RED,
+}
+
+# Color for transfer results, passed with extra={'color': RESULT_COLOR}
+RESULT_COLOR = Fore.WHITE + Back.GREEN
+
+
+class ColorFormatter(logging.Formatter):
+    """
+    Formatter that wraps each message in the color of its level (or the record's 'color' attribute).
+    """
+
+    def format(self, record):
+        message = super().format(record)
+        if not USE_COLOR:
+            return message
+        color = getattr(record, 'color', LEVEL_COLORS.get(record.levelno, ''))
+        return color + message + Style.RESET_ALL
+
+
+# A single handler shared by every logger of the application
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(ColorFormatter())
+
+_root_logger = logging.getLogger('speedtest')
+_root_logger.addHandler(_handler)
+_root_logger.setLevel(logging.INFO)   # Per packet messages are logged at DEBUG and hidden by default
+_root_logger.propagate = False
+
+
+def get_logger(name):
+    """
+    Return the logger of a module, all of them write through the shared handler.
+    """
+    return _root_logger.getChild(name)
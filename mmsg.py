@@ -0,0 +1,188 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+from config import *
+
+
+class IOVec(ctypes.Structure):
+    """
+    struct iovec from <sys/uio.h>
+    """
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    """
+    struct msghdr from <sys/socket.h>
+    """
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    """
+    struct mmsghdr from <sys/socket.h>
+    """
+    _fields_ = [("msg_hdr", MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    """
+    Load the C library if it exposes sendmmsg and recvmmsg (Linux only), otherwise return None.
+    """
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.sendmmsg.restype = ctypes.c_int
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.recvmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        return None   # No sendmmsg/recvmmsg on this platform, fall back to one call per datagram
+    return libc
+
+
+_libc = _load_libc()
+
+
+def _buffer_address(buffer):
+    """
+    Return the address of the first byte of a bytes-like object without copying it.
+    """
+    if isinstance(buffer, bytes):
+        return ctypes.cast(ctypes.c_char_p(buffer), ctypes.c_void_p).value
+    return ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer))
+
+
+class SendBatch:
+    """
+    Pre-built batch of up to MMSG_BATCH datagrams sent with a single sendmmsg call.
+
+    Every datagram is made of its own header slot followed by the same payload,
+    the message headers pointing at them are built once so sending a batch only
+    requires writing the headers into the header buffer.
+    """
+
+    def __init__(self, header_size, payload, count=MMSG_BATCH):
+        self.header_size = header_size
+        self.payload = payload
+        self.headers = bytearray(header_size * count)   # Header slots, written by the caller before each send
+        headers_view = memoryview(self.headers)
+        self._header_views = [headers_view[i * header_size:(i + 1) * header_size] for i in range(count)]
+
+        # Keep the ctypes view of the header buffer alive so its address stays valid
+        self._headers_ref = (ctypes.c_char * len(self.headers)).from_buffer(self.headers)
+        headers_address = ctypes.addressof(self._headers_ref)
+        payload_address = _buffer_address(payload)
+
+        # Two iovecs per datagram: its header slot and the shared payload
+        self._iovecs = (IOVec * (2 * count))()
+        self._messages = (MMsgHdr * count)()
+        for index in range(count):
+            header_iovec, payload_iovec = self._iovecs[2 * index], self._iovecs[2 * index + 1]
+            header_iovec.iov_base = headers_address + index * header_size
+            header_iovec.iov_len = header_size
+            payload_iovec.iov_base = payload_address
+            payload_iovec.iov_len = len(payload)
+            self._messages[index].msg_hdr.msg_iov = ctypes.pointer(header_iovec)
+            self._messages[index].msg_hdr.msg_iovlen = 2
+
+    def send(self, sock, count, last_payload_size=None):
+        """
+        Send the first count datagrams of the batch on a connected UDP socket.
+
+        On Linux the datagrams are handed to the kernel with a single sendmmsg call,
+        on other platforms each datagram is sent separately.
+
+        Parameters:
+        - sock: A connected UDP socket.
+        - count: Number of header slots to send, at most the batch size.
+        - last_payload_size: Payload size of the last datagram if it is shorter than the payload.
+        """
+        if last_payload_size is None:
+            last_payload_size = len(self.payload)
+
+        if _libc is None:
+            for index in range(count):
+                payload_size = last_payload_size if index == count - 1 else len(self.payload)
+                sock.send(self._header_views[index].tobytes() + self.payload[:payload_size])
+            return
+
+        last_payload_iovec = self._iovecs[2 * count - 1]
+        last_payload_iovec.iov_len = last_payload_size
+        try:
+            # sendmmsg may send only part of the batch, keep going until everything was sent
+            sent = 0
+            while sent < count:
+                result = _libc.sendmmsg(sock.fileno(), ctypes.addressof(self._messages[sent]), count - sent, 0)
+                if result < 0:
+                    error_number = ctypes.get_errno()
+                    if error_number == errno.EINTR:
+                        continue   # Interrupted by a signal before anything was sent, just retry
+                    raise OSError(error_number, os.strerror(error_number))
+                sent += result
+        finally:
+            last_payload_iovec.iov_len = len(self.payload)
+
+
+class ReceiveBatch:
+    """
+    Pre-allocated buffers for receiving up to MMSG_BATCH datagrams with a single recvmmsg call.
+
+    The buffers and the message headers pointing at them are built once and reused
+    by every receive, so receiving allocates no datagram buffers.
+    """
+
+    def __init__(self, buffer_size, count=MMSG_BATCH):
+        self.buffer = bytearray(buffer_size * count)
+        buffer_view = memoryview(self.buffer)
+        self.views = [buffer_view[i * buffer_size:(i + 1) * buffer_size] for i in range(count)]
+
+        # Keep the ctypes view of the buffer alive so its address stays valid
+        self._buffer_ref = (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer)
+        base_address = ctypes.addressof(self._buffer_ref)
+
+        self._iovecs = (IOVec * count)()
+        self._messages = (MMsgHdr * count)()
+        for index in range(count):
+            self._iovecs[index].iov_base = base_address + index * buffer_size
+            self._iovecs[index].iov_len = buffer_size
+            self._messages[index].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[index])
+            self._messages[index].msg_hdr.msg_iovlen = 1
+
+    def receive(self, sock):
+        """
+        Receive the datagrams waiting on a UDP socket.
+
+        Waits up to the socket timeout for the first datagram and raises socket.timeout
+        if nothing arrives. On Linux the datagrams already queued behind it (up to the batch size)
+        are read with one recvmmsg call, on other platforms a single datagram is read.
+
+        Returns:
+            List of memoryviews over the reused buffers, one per received datagram.
+            The views are only valid until the next call.
+        """
+        # Wait for the first datagram with a regular receive, it honors the socket timeout
+        received = [self.views[0][:sock.recv_into(self.views[0])]]
+        if _libc is None:
+            return received
+
+        # Read whatever else is already queued into the remaining buffers without waiting
+        result = _libc.recvmmsg(sock.fileno(), ctypes.addressof(self._messages[1]), len(self.views) - 1, socket.MSG_DONTWAIT, None)
+        if result < 0:
+            error_number = ctypes.get_errno()
+            if error_number in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return received   # Nothing else queued
+            raise OSError(error_number, os.strerror(error_number))
+        return received + [self.views[index][:self._messages[index].msg_len] for index in range(1, result + 1)]
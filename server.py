@@ -1,60 +1,87 @@
+import errno
+import mmap
+import os
+import selectors
 import socket
+import sys
+import tempfile
 import threading
-import time
 import struct
-import random
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, repeat
 from config import *
-from colorama import init, Fore , Back
+from mmsg import SendBatch
+from log import get_logger
 
-# Initialize the library for colored output in the terminal
-init(autoreset=True)
+logger = get_logger('server')
 
+# Linux pacing option, not exposed by the socket module
+SO_MAX_PACING_RATE = getattr(socket, 'SO_MAX_PACING_RATE', 47)
 
-def allocate_port(start, end, protocol):
+
+def allocate_port(protocol):
     """
-    Find an available port for a specified protocol.
-    This function will check for an available port in the specified range 
-    and return the first available one.
+    Create a socket for a specified protocol bound to an available port.
+    This function binds to port 0 and lets the kernel pick a free ephemeral port,
+    the bound socket is returned so the port can't be taken before it is used.
     """
     # Select socket type based on protocol (TCP or UDP)
     proto = socket.SOCK_STREAM if protocol == 'tcp' else socket.SOCK_DGRAM   #creating a socket
 
-    for port in range(start, end + 1):
-        with socket.socket(socket.AF_INET, proto) as sock:
-            try:
-                # Try binding to the port, if it works, the port is available
-                sock.bind(('0.0.0.0', port))
-                return port   #Return port number
-            except OSError:
-                continue   #If the port is not available try another
-    
-    # If no available port is found, raise an exception        
-    raise RuntimeError("No available port found.")
+    sock = socket.socket(socket.AF_INET, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', 0))   # Port 0 asks the kernel for any available port
+    return sock   #Return the bound socket
 
 
 
 
-def offer_broadcast(udp_port, tcp_port):
+def offer_broadcast(udp_port, tcp_port, stop_event):
     """
     Broadcasts offers to all clients on the network over UDP.
     This function sends out an 'offer' message containing the UDP and TCP ports 
-    that the server is using. The offer is sent every second.
+    that the server is using. The offer is sent every second until stop_event is set.
     """
     # Pack the offer packet with the server's UDP and TCP port
-    offer_packet = struct.pack('!IBHH', MAGIC_COOKIE, MTYPE_OFFER, udp_port, tcp_port)
+    offer_packet = OFFER_STRUCT.pack(MAGIC_COOKIE, MTYPE_OFFER, udp_port, tcp_port)
 
     # Create a UDP socket to send the broadcast message
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as broadcast_offer_socket:
         broadcast_offer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # Enable broadcasting
-        while True:
-            # Send the offer packet to all clients on the network
-            broadcast_offer_socket.sendto(offer_packet, ('172.18.255.255', BROADCAST_PORT))  # Broadcasting on port 13117
-            time.sleep(1)  # Sleep for 1 second before broadcasting again
+        while not stop_event.is_set():
+            try:
+                # Send the offer packet to all clients on the network
+                broadcast_offer_socket.sendto(offer_packet, (BROADCAST_ADDRESS, BROADCAST_PORT))
+            except OSError as error:
+                logger.error(f"Failed to broadcast offer: {error}")
+            stop_event.wait(1)  # Wait 1 second before broadcasting again, returns early on shutdown
+
+
+
+
+def create_payload_source():
+    """
+    Create an in-memory file filled with random data to be used as the TCP payload.
+    The payload content is irrelevant for a speed test, so every transfer repeats this file.
+
+    Returns:
+        Tuple: (payload_file, payload_view) the file for sendfile and a read-only memory map of it.
+    """
+    # Anonymous memory backed file on Linux, a regular temporary file elsewhere
+    if hasattr(os, 'memfd_create'):
+        payload_file = open(os.memfd_create('speedtest', os.MFD_CLOEXEC), 'w+b')
+    else:
+        payload_file = tempfile.TemporaryFile()
 
+    payload_file.write(os.urandom(PAYLOAD_FILE_SIZE))
+    payload_file.flush()
+    payload_view = memoryview(mmap.mmap(payload_file.fileno(), PAYLOAD_FILE_SIZE, access=mmap.ACCESS_READ))
+    return payload_file, payload_view
 
 
 
-def process_tcp_connection(connection, client_address):
+
+def process_tcp_connection(connection, client_address, payload_file, payload_view):
     """
     Process file transfer requests over a TCP connection.
 
@@ -62,37 +89,72 @@ def process_tcp_connection(connection, client_address):
     1. Receive the requested file size from the client.
     2. Send the requested amount of data back to the client.
     3. Close the connection after sending the data.
+
+    The data is sent from the payload file with sendfile so the kernel copies it straight
+    to the socket, where sendfile isn't available it is sent from the payload memory map.
     """
     try:
+        # Send without Nagle's delay and acknowledge the small size request right away
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, 'TCP_QUICKACK'):
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)   # Linux only
+
         # Receive the file size from the client
         received_data = connection.recv(CONST_SIZE).decode().strip()  # Read a fixed size of bytes and decode
         total_file_size = int(received_data)  # Convert the received size to an integer
 
         bytes_transferred = 0  # Tracks the total number of bytes sent
-        chunk_size = CONST_SIZE * 8  # Defines the size of each data chunk (8KB)
+        use_sendfile = hasattr(os, 'sendfile')
 
-        # Loop to send the file in chunks
+        # Loop to send the file in chunks, wrapping around the payload file
         while bytes_transferred < total_file_size:
+            file_offset = bytes_transferred % PAYLOAD_FILE_SIZE  # Position in the payload file
             remaining_bytes = total_file_size - bytes_transferred  # Calculate remaining bytes to send
-            current_chunk_size = min(chunk_size, remaining_bytes)  # Determine the size of the next chunk
-            chunk_data = bytearray(random.getrandbits(8) for _ in range(current_chunk_size))  # Generate random data
+            current_chunk_size = min(PAYLOAD_FILE_SIZE - file_offset, remaining_bytes)  # Determine the size of the next chunk
 
             try:
-                connection.sendall(chunk_data)  # Send the data chunk
+                if use_sendfile:
+                    try:
+                        # Send the data chunk, may send less than requested
+                        current_chunk_size = os.sendfile(connection.fileno(), payload_file.fileno(), file_offset, current_chunk_size)
+                    except OSError as error:
+                        if error.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                            raise
+                        use_sendfile = False   # The socket doesn't support sendfile, send from memory instead
+                        continue
+                else:
+                    connection.sendall(payload_view[file_offset:file_offset + current_chunk_size])  # Send the data chunk
             except Exception as e:
-                print(Fore.WHITE + Back.RED + f"Error: Connection with {client_address} lost unexpectedly.")  # Log connection issue
+                logger.error(f"Error: Connection with {client_address} lost unexpectedly.")  # Log connection issue
                 break  # Exit the loop if an error occurs
 
             bytes_transferred += current_chunk_size  # Update the transferred bytes counter
 
     except ValueError:
-        print(Fore.WHITE + Back.RED + f"Invalid file size received from {client_address}.")  # Log invalid file size error
+        logger.error(f"Invalid file size received from {client_address}.")  # Log invalid file size error
+    except OSError as error:
+        logger.error(f"Error: Connection with {client_address} failed: {error}")  # Log connection issue before the transfer
     finally:
         connection.close()  # Ensure the connection is closed after processing
 
 
 
 
+def set_pacing_rate(sock, bytes_per_second):
+    """
+    Limit the send rate of a socket in the kernel (Linux only, needs the fq qdisc for UDP).
+    Without a rate (None or 0) or elsewhere the socket sends at full speed.
+    """
+    if not bytes_per_second or not sys.platform.startswith('linux'):
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, bytes_per_second)
+    except OSError:
+        pass   # Pacing isn't supported by this kernel
+
+
+
+
 def process_udp_connection(packet_data, client_address):
     """
     Processes incoming UDP packets and responds with segmented payloads.
@@ -108,11 +170,11 @@ def process_udp_connection(packet_data, client_address):
     """
     try:
         # Extract values from the incoming packet using the expected structure
-        cookie, message_type, file_size_bytes = struct.unpack('!IBQ', packet_data)
+        cookie, message_type, file_size_bytes = REQUEST_STRUCT.unpack(packet_data)
 
         # Validate the values
         if cookie != MAGIC_COOKIE or message_type != MTYPE_REQUEST:
-            print(Fore.WHITE + Back.RED + "Received invalid magic cookie or message type. Ignoring packet.")
+            logger.debug("Received invalid magic cookie or message type. Ignoring packet.")
             return
 
         # Calculate how many segments are needed based on the requested data size
@@ -120,41 +182,42 @@ def process_udp_connection(packet_data, client_address):
 
         # Initialize a new UDP socket for sending the response
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CONST_SIZE)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        set_pacing_rate(udp_socket, UDP_PACING_RATE)   # Let the kernel space out the batches if a rate is configured
 
         try:
-            # Generate the segments
-            segments_list = []
-            for segment_index in range(num_segments):
-                remaining_bytes = file_size_bytes - (segment_index * CONST_SIZE)
-                current_chunk_size = min(CONST_SIZE, remaining_bytes)
+            # Every segment shares the same random payload, only the segment index changes between headers
+            batch = SendBatch(PAYLOAD_HEADER_STRUCT.size, os.urandom(CONST_SIZE))
 
-                # Generate random payload data
-                payload_data = bytearray(random.getrandbits(8) for _ in range(current_chunk_size))
+            # The last segment only carries the remainder of the requested data
+            last_payload_size = file_size_bytes - (num_segments - 1) * CONST_SIZE
 
-                # Create the payload header
-                payload_header = struct.pack('!IBQQ', MAGIC_COOKIE, MTYPE_PAYLOAD, num_segments, segment_index)
+            # Connect the socket to the client so the batches don't need a destination address
+            udp_socket.connect(client_address)
 
-                # Add the full segment (header + payload) to the list
-                segments_list.append(payload_header + payload_data)
+            # Send the segments in batches, one system call per batch
+            for start_index in range(0, num_segments, MMSG_BATCH):
+                # Write the headers of the whole batch with a single call, the fields are generated by C-level iterators
+                header_fields = zip(repeat(MAGIC_COOKIE), repeat(MTYPE_PAYLOAD), repeat(num_segments),
+                                    range(start_index, start_index + MMSG_BATCH))
+                BATCH_HEADER_STRUCT.pack_into(batch.headers, 0, *chain.from_iterable(header_fields))
 
-            # Send the segments in bursts to avoid network congestion
-            burst_limit = 32
-            for start_index in range(0, num_segments, burst_limit):
-                for segment_index in range(start_index, min(start_index + burst_limit, num_segments)):
-                    udp_socket.sendto(segments_list[segment_index], client_address)
-                time.sleep(0.001)  # Add a short delay between bursts to reduce congestion
+                batch_size = min(MMSG_BATCH, num_segments - start_index)
+                if start_index + batch_size == num_segments:
+                    batch.send(udp_socket, batch_size, last_payload_size)
+                else:
+                    batch.send(udp_socket, batch_size)
 
         finally:
             udp_socket.close()
 
     except struct.error:
         # Handle errors if the incoming packet doesn't match the expected format
-        print(Fore.WHITE + Back.RED + "Failed to unpack the packet. Invalid format.")
+        logger.debug("Failed to unpack the packet. Invalid format.")
 
     except Exception as error:
         # Handle any unexpected errors during the process
-        print(Fore.WHITE + Back.RED + f"An unexpected error occurred while processing the UDP packet: {error}")
+        logger.error(f"An unexpected error occurred while processing the UDP packet: {error}")
 
 
 
@@ -164,45 +227,66 @@ def run_server():
     Start running the server, broadcasts offers, and listens for incoming TCP and UDP connections.
     """
     server_ip = socket.gethostbyname(socket.gethostname())
-    print(Fore.CYAN + Back.MAGENTA + f"Team {TEAM_NAME} Server started, listening on IP address {server_ip}")
-    
-    # allocate port for TCP and UDP to be used in the offer broadcast thread 
-    udp_port = allocate_port(1025, 65535, 'udp')
-    tcp_port = allocate_port(1025, 65535, 'tcp')
+    logger.info(f"Team {TEAM_NAME} Server started, listening on IP address {server_ip}")
     
-    # Start the broadcast thread
-    threading.Thread(target=offer_broadcast, args=(udp_port, tcp_port), daemon=True).start()
-
-    # Setting up the TCP listener socket
-    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_socket.bind(('', tcp_port))   # Binding the socket to the selected TCP port
+    # Setting up the TCP listener socket on an allocated port
+    tcp_socket = allocate_port('tcp')
     tcp_socket.listen(10)  # Set maximum pending connections to 10
 
-    # Setting up the UDP listener socket
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.bind(('', udp_port))   # Binding the socket to the selected UDP port
+    # Setting up the UDP listener socket on an allocated port
+    udp_socket = allocate_port('udp')
 
-    while True:
-        try:
-            tcp_socket.setblocking(False)  # Non-blocking mode
-            # Handle TCP client connection
-            try:
-                conn, addr = tcp_socket.accept()
-                thread = threading.Thread(target=process_tcp_connection, args=(conn, addr), daemon=True)
-                thread.start()
-            except BlockingIOError:
-                pass  # No incoming TCP connections
-
-            udp_socket.setblocking(False)  # Non-blocking mode
-            # Handle UDP packets
+    # Read the allocated ports to be used in the offer broadcast thread
+    udp_port = udp_socket.getsockname()[1]
+    tcp_port = tcp_socket.getsockname()[1]
+
+    # Start the broadcast thread, stopped through the event when the server shuts down
+    stop_event = threading.Event()
+    threading.Thread(target=offer_broadcast, args=(udp_port, tcp_port, stop_event), daemon=True).start()
+
+    # Random payload shared by every TCP transfer
+    payload_file, payload_view = create_payload_source()
+
+    # Worker pools serving the transfers, created once so no thread is spawned per request
+    tcp_pool = ThreadPoolExecutor(max_workers=MAX_TCP_WORKERS)
+    udp_pool = ThreadPoolExecutor(max_workers=MAX_UDP_WORKERS)
+
+    # Both listeners are non-blocking and watched by a selector (epoll/kqueue) so the loop sleeps until one is ready
+    tcp_socket.setblocking(False)
+    udp_socket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(tcp_socket, selectors.EVENT_READ)
+    selector.register(udp_socket, selectors.EVENT_READ)
+
+    try:
+        while True:
             try:
-                data, addr = udp_socket.recvfrom(CONST_SIZE)
-                threading.Thread(target=process_udp_connection, args=(data, addr), daemon=True).start()
-            except BlockingIOError:
-                pass  # No incoming UDP packets
+                for key, _ in selector.select():
+                    try:
+                        # Handle everything already queued on the ready socket before waiting again
+                        while True:
+                            if key.fileobj is tcp_socket:
+                                # Handle TCP client connection
+                                conn, addr = tcp_socket.accept()
+                                tcp_pool.submit(process_tcp_connection, conn, addr, payload_file, payload_view)
+                            else:
+                                # Handle UDP packets
+                                data, addr = udp_socket.recvfrom(CONST_SIZE)
+                                udp_pool.submit(process_udp_connection, data, addr)
+                    except BlockingIOError:
+                        pass  # No more pending connections or packets
+
+            except Exception as e:
+                logger.error(f"An unexpected error occurred: {str(e)}")
 
-        except Exception as e:
-            print(Fore.WHITE + Back.RED + f"An unexpected error occurred: {str(e)}")
+    finally:
+        # Stop broadcasting offers, drop the queued transfers and release the listeners
+        stop_event.set()
+        tcp_pool.shutdown(wait=False, cancel_futures=True)
+        udp_pool.shutdown(wait=False, cancel_futures=True)
+        selector.close()
+        tcp_socket.close()
+        udp_socket.close()
 
 
 if __name__ == "__main__":